@@ -7,23 +7,24 @@
 from __future__ import annotations
 
 import argparse
-import json
 import logging
 import logging.handlers
 import mplfinance as mpf
+import msgspec
+import numpy as np
 import os
 import pandas as pd
 import requests
+import requests_cache
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
-from collections import deque
 from dotenv import load_dotenv
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from pathlib import Path
-from typing import Optional, List, Union, Tuple
+from typing import Iterator, Optional, Tuple
 
 #############
 # Constants #
@@ -35,6 +36,14 @@ API_KEY = {"Authorization": f"Bearer {os.getenv('TOKEN')}", "Accept": "applicati
 BASE = "https://lichess.org"
 GAME_API = BASE + "/api/games/user/{}"
 LOG_PATH = f"tradeBoard.log"
+CACHE_PATH = "lichess_cache"
+CACHE_EXPIRATION = 3600 # seconds
+CHUNK_SIZE = 65536 # bytes read at once from the games stream
+DAY_MS = 86_400_000
+DAYS_BUFFER_SIZE = 1024 # initial number of days buffered when `max_games` is not set
+COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+DATE_FORMAT = "%Y-%m-%d"
+OHLCV_AGG = {"Open": "first", "High": "max", "Low": "min", "Close": "last", "Volume": "sum"}
 RETRY_STRAT = Retry(
     total=5,
     backoff_factor=1,
@@ -68,49 +77,45 @@ log.addHandler(handler_2)
 # Classes #
 ###########
 
+# Only the fields of a game used, the others are skipped when decoding
+
+class User(msgspec.Struct):
+    id: str
+
+class Player(msgspec.Struct, rename="camel"):
+    user: User
+    rating: int
+    rating_diff: int = 0
+
+class Players(msgspec.Struct):
+    white: Player
+    black: Player
+
+class Game(msgspec.Struct, rename="camel"):
+    last_move_at: int
+    players: Players
 
-class Day:
-    datetime: "datetime"
-    close: int
-    open: Optional[int]
-    high: int
-    low: int
-    volume: int
-
-    def __init__(self, date: datetime, close: int, before: int, after: int) -> None:
-        self.date = date
-        self.close = close
-        self.open = None
-        self.high = 0
-        self.low = 3999
-        self.volume = 0
-        self.update(before, after)
-
-    def update(self, before: int, after: int) -> None:
-        # Remember, games are fetched in reverse chronological order
-        self.open = before
-        self.high = max(self.high, before, after)
-        assert self.high >= max(before, after)
-        self.low = min(self.low, before, after)
-        self.volume += 1
-        # log.debug(f"{self.volume} games on day {self.date}")
-
-    def to_list(self) -> List[Union[datetime, int]]:
-        assert self.open
-        return [self.open, self.high, self.low, self.close, self.volume]
 
 class LichessTradingBoard:
 
-    def __init__(self, user: str, perf_type: str, max_games: Optional[int] = None, update: bool = False) -> None:
+    def __init__(self, user: str, perf_type: str, max_games: Optional[int] = None, update: bool = False, cache: bool = False) -> None:
         self.user = user.casefold()
         self.perf_type = perf_type
         self.max_games = max_games
         self.path = Path(f'./downloads/{self.user}/{self.perf_type}.csv')
         self.df = self.get_panda(update)
-        http = requests.Session()
+        if cache:
+            # Downloaded games are cached for a while, to not fetch them again when recomputing a graph.
+            # The whole response is then read before being returned, games are no longer streamed
+            http = requests_cache.CachedSession(CACHE_PATH, backend="sqlite", expire_after=CACHE_EXPIRATION, stale_if_error=True)
+        else:
+            http = requests.Session()
+        http.headers.update(API_KEY)
         http.mount("https://", ADAPTER)
         http.mount("http://", ADAPTER)
         self.http = http
+        # Reused for every game
+        self.decoder = msgspec.json.Decoder(Game)
 
     def get_panda(self, update: bool) -> pd.PandaFrame:
         """
@@ -119,70 +124,118 @@ class LichessTradingBoard:
         """
         if self.path.exists() and not update:
             log.info("Existing dataframe found, using it")
-            df = pd.read_csv(self.path,index_col=0, parse_dates=True)
+            # Known dtypes and date format, so pandas does not have to infer them
+            df = pd.read_csv(self.path, index_col=0, dtype={column: float for column in COLUMNS})
+            df.index = pd.to_datetime(df.index, format=DATE_FORMAT)
             df.index.name = "Date"
             return df
         log.info("No dataframe found, creating it")
-        df = pd.DataFrame(columns=["Open", "High", "Low", "Close", "Volume"], index=pd.DatetimeIndex([], name='Date'))
-        log.debug(f"Returned df: {df}")
+        df = pd.DataFrame(columns=COLUMNS, index=pd.DatetimeIndex([], name='Date'))
+        log.debug("Returned df: %s", df)
         return df
 
     def save_df(self) -> None:
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.df.to_csv(self.path)
+        self.df.to_csv(self.path, date_format=DATE_FORMAT)
 
     def fetch_games(self) -> None:
-        buffer: deque[Day] = deque()
-        log.info(f"{self.max_games} asked, about {self.max_games // 30}s to fetch them, if the player only play that time control.")
-        r = self.http.get(GAME_API.format(self.user), params={"moves": False, "rated": True, "perfType": self.perf_type, "max": self.max_games, "variant": "standard"}, headers=API_KEY, stream=True)
-        # reverse chronological order
-        for game_raw in r.iter_lines():
-            game = json.loads(game_raw.decode())
-            date = datetime.combine(datetime.utcfromtimestamp(game["lastMoveAt"] / 1000).date(), datetime.min.time())
-            before, after = self.get_rating(game)
-            if len(buffer) == 1 and buffer[0].date == date:
-                buffer[0].update(before, after)
-            else:
-                log.info(f"Started computing day {date}")
-                buffer.append(Day(date=date, before=before, after=after, close=after)) # Last game of the day first
-            if buffer[0].date != date: # We've started a new day
-                # Save the computed day, if it's not the first game we've received
-                log.debug(f"Last game of {date}: {game}")
-                finished_day = buffer.popleft()
-                self.df.loc[finished_day.date] = finished_day.to_list()
-                log.debug(self.df)
-        self.df = self.df.sort_index() # Put back the data in chronological order
-        self.df = self.df.astype(float)
-
-    def get_rating(self, game) -> Tuple[int, int]:
-        """Return the rating for the player `user` before and after the game"""
+        # Preallocated, the number of days is bounded by `max_games`. Grown as needed otherwise
+        size = self.max_games or DAYS_BUFFER_SIZE
+        # Day since epoch (UTC), open, high, low, close, volume
+        # Filled from the end, games being received newest first. They are sorted by creation date though,
+        # so a day is closed as soon as another one comes, and can be split when games overlap in time
+        days = np.empty((size, 6), dtype=np.int64)
+        i = size # index of the day currently computed
+        # The day currently computed is kept in locals, and only written in `days` once complete
+        day: Optional[int] = None
+        opening = high = low = closing = volume = 0
+        n = 0
+        if self.max_games is None:
+            log.info("All games asked")
+        else:
+            log.info(f"{self.max_games} asked, about {self.max_games // 30}s to fetch them, if the player only play that time control.")
+        with self.http.get(GAME_API.format(self.user), params={"moves": False, "rated": True, "perfType": self.perf_type, "max": self.max_games, "variant": "standard"}, stream=True) as r:
+            for game_raw in self.iter_ndjson(r):
+                last_move_at, before, after = self.read_game(game_raw)
+                n += 1
+                if last_move_at // DAY_MS == day:
+                    opening = before # The earliest game so far is the opening one
+                    high = max(high, before, after)
+                    low = min(low, before, after)
+                    volume += 1
+                else:
+                    if day is not None:
+                        days[i] = day, opening, high, low, closing, volume
+                    if i == 0: # Only when `max_games` is not set
+                        days = np.concatenate((np.empty_like(days), days))
+                        i = size
+                        size *= 2
+                    i -= 1
+                    day = last_move_at // DAY_MS
+                    log.info(f"Started computing day {np.datetime64(day, 'D')}")
+                    opening, high, low, closing, volume = before, max(before, after), min(before, after), after, 1 # Last game of the day first
+        if day is not None:
+            days[i] = day, opening, high, low, closing, volume
+        dates, opens, highs, lows, closes, volumes = days[i:].T
+        log.info(f"{len(dates)} days computed from {n} games")
+        # Build the frame once, column by column
+        self.df = pd.DataFrame(
+            {"Open": opens, "High": highs, "Low": lows, "Close": closes, "Volume": volumes},
+            index=pd.to_datetime(dates, unit="D").rename("Date"),
+        ).astype(float)
+        # Lichess sorts games by creation date, not by last move, so games overlapping in time
+        # (eg correspondence) can make days come out of order, or split over several rows
+        if not self.df.index.is_monotonic_increasing:
+            self.df = self.df.sort_index(kind="stable")
+        if not self.df.index.is_unique:
+            # The stable sort keeps the parts of a day by creation date, earliest first
+            self.df = self.df.groupby(level=0).agg(OHLCV_AGG)
+
+    def iter_ndjson(self, r: requests.Response) -> Iterator[bytes]:
+        """
+        Yield the non-empty lines of a NDJSON stream.
+        Read by big chunks and split manually, `Response.iter_lines` having a lot of per-line overhead
+        """
+        tail = b""
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            *lines, tail = (tail + chunk).split(b"\n")
+            yield from filter(None, lines)
+        if tail:
+            yield tail
+
+    def read_game(self, game_raw: bytes) -> Tuple[int, int, int]:
+        """Return `lastMoveAt` of the game, and the rating of the player `user` before and after it"""
         try:
-            players = game["players"]
-            # log.debug(players)
-            if self.user in players["white"]["user"]["id"]:
-                before = int(players["white"]["rating"])
-                after = before + int(players["white"].get("ratingDiff", 0))
-                return before, after
-            before = int(players["black"]["rating"])
-            after = before + int(players["black"].get("ratingDiff", 0))
-        except KeyError as e:
+            game = self.decoder.decode(game_raw)
+        except msgspec.ValidationError as e:
             log.error(e)
-            log.error(f"Data: {game}")
+            log.error(f"Data: {game_raw}")
             raise Exception(e)
-        return before, after
+        # ids are lowercased by lichess, like `self.user`
+        player = game.players.white if game.players.white.user.id == self.user else game.players.black
+        return game.last_move_at, player.rating, player.rating + player.rating_diff
 
-    def show(self, df: Optional[pd.Dataframe] = None) -> None:
+    def show(self, df: Optional[pd.Dataframe] = None, weekly: bool = False) -> None:
         if df is None:
             df = self.df
+        if weekly:
+            # Weeks start on monday and are labelled by it, so no candle is dated after its games
+            df = df.resample("W-MON", closed="left", label="left").agg(OHLCV_AGG).dropna()
         mc = mpf.make_marketcolors(up='g',down='r')
         s  = mpf.make_mpf_style(marketcolors=mc)
         mpf.plot(df, type='candle', volume=True, style=s, ylabel='Rating', ylabel_lower="Games", title=f"{self.user} • {self.perf_type}")
 
-    def run(self) -> None:
+    def run(self, weekly: bool = False) -> None:
         if self.df.empty:
             self.fetch_games()
-        self.save_df()
-        self.show()
+        # Write the dataframe to disk while the graph is being rendered
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            saved = executor.submit(self.save_df)
+            try:
+                self.show(weekly=weekly)
+            finally:
+                # Surface a failed write even if plotting failed
+                saved.result()
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -190,9 +243,11 @@ def main() -> None:
     parser.add_argument("perf", help="Type of games you want to graph, can be either a time control or a variant name")
     parser.add_argument("games", nargs='?', default=None, type=int, help="Number of games you want to fetch, default all")
     parser.add_argument("update", nargs='?', default=False, type=bool, help="If you want to recompute a graph, default to `False`")
+    parser.add_argument("--cache", action="store_true", help="Cache downloaded games for an hour, to not fetch them again when recomputing a graph. Games are no longer streamed")
+    parser.add_argument("--weekly", action="store_true", help="Plot one candle per week instead of per day, more readable for long histories")
     args = parser.parse_args()
-    board = LichessTradingBoard(args.player, args.perf, args.games, args.update)
-    board.run()
+    board = LichessTradingBoard(args.player, args.perf, args.games, args.update, args.cache)
+    board.run(args.weekly)
 
 ########
 # Main #